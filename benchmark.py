@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+"""Benchmarks the build pipeline end to end without an AWS account.
+
+lambda_handler runs in-process against synthetic repositories served by a local Dulwich git server. S3 and Lambda
+are replaced by in-memory stand-ins (or moto, with --moto). Each scenario is timed per phase using the trace that
+lambda_handler returns, along with peak memory and /tmp footprint, and compared with a stored baseline.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from base64 import b64encode
+from contextlib import redirect_stdout
+from hashlib import sha256
+from shutil import disk_usage, rmtree
+
+repo_root = os.path.dirname(os.path.abspath(__file__))
+work_dir = '/tmp/benchmark'
+username = 'bench'
+function_name = 'bench-app'
+account_id = '123456789012'
+region = 'us-east-1'
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--files', type=int, default=200, help='number of source files in the function package')
+parser.add_argument('--file-size', type=int, default=8, help='size of each source file in KB')
+parser.add_argument('--layers', type=int, default=2, help='number of user-defined data layers')
+parser.add_argument('--layer-size', type=int, default=16, help='size of each data layer in MB')
+parser.add_argument('--editable', type=int, default=2, help='number of editable (-e) dependencies')
+parser.add_argument('--random-data', action='store_true', help='fill data layers with incompressible bytes')
+parser.add_argument('--runs', type=int, default=3, help='number of times each scenario is run')
+parser.add_argument('--latency-ms', type=float, default=0, help='simulated latency of each AWS API call')
+parser.add_argument('--bandwidth-mbps', type=float, default=0, help='simulated S3 upload bandwidth (0 = unlimited)')
+parser.add_argument('--moto', action='store_true', help='use moto instead of the built-in AWS stand-ins')
+parser.add_argument('--baseline', default='benchmark_baseline.json', help='baseline file to compare against')
+parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+parser.add_argument('--tolerance', type=float, default=20, help='allowed regression against the baseline in percent')
+parser.add_argument('--log', default=os.path.join(work_dir, 'benchmark.log'), help='file that receives build output')
+args = parser.parse_args()
+
+os.environ.update({
+    'AWS_REGION': region,
+    'AWS_DEFAULT_REGION': region,
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_EXECUTION_ENV': 'AWS_Lambda_python{}.{}'.format(*sys.version_info[:2]),
+    'AWS_LAMBDA_FUNCTION_NAME': 'lambda-lambda-lambda',
+    'LAMBDA_TASK_ROOT': repo_root,
+    'deploy_bucket': 'benchmark-deployments',
+    'git_username': username,
+    'git_token': '',
+    # the build scripts call `python` and must get this interpreter; pip must never reach the network
+    'PATH': os.path.dirname(sys.executable) + os.pathsep + os.environ.get('PATH', ''),
+    'PIP_NO_INDEX': '1',
+    'PIP_DISABLE_PIP_VERSION_CHECK': '1',
+})
+
+from botocore.exceptions import ClientError  # noqa: E402
+from dulwich import porcelain  # noqa: E402
+from dulwich.repo import Repo  # noqa: E402
+from dulwich.server import DictBackend, TCPGitServer  # noqa: E402
+
+
+class BenchmarkBackend(DictBackend):
+    """Serves repositories by URL path, whichever string type the installed Dulwich passes in"""
+
+    def open_repository(self, path):
+        if isinstance(path, bytes):
+            path = path.decode()
+        return super(BenchmarkBackend, self).open_repository(path)
+
+
+class StubS3(object):
+    """In-memory stand-in for the parts of the S3 client that the builder uses"""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def _delay(self, size=0):
+        delay = args.latency_ms / 1000
+        if args.bandwidth_mbps and size:
+            delay += size * 8 / (args.bandwidth_mbps * 1000000)
+        time.sleep(delay)
+
+    def _missing(self, operation):
+        return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not Found'}}, operation)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._delay()
+        with self.lock:
+            upload_id = str(len(self.uploads) + 1)
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._delay(len(Body))
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': sha256(Body).hexdigest()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._delay()
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+            self.objects[(Bucket, Key)] = b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._delay()
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._delay(len(Body))
+        self.objects[(Bucket, Key)] = bytes(Body)
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as f:
+            self.put_object(Bucket, Key, f.read())
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._delay()
+        if (Bucket, Key) not in self.objects:
+            raise self._missing('GetObject')
+        body = self.objects[(Bucket, Key)]
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._delay()
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+
+class StubLambda(object):
+    """In-memory stand-in for the parts of the Lambda client that the builder uses"""
+
+    class exceptions(object):
+        class ResourceNotFoundException(Exception):
+            pass
+
+    def __init__(self, s3):
+        self.s3 = s3
+        self.layers = {}
+        self.aliases = {}
+        self.versions = []
+        self.functions = {}
+        self.lock = threading.Lock()
+
+    def _response(self, status=200, **body):
+        self._delay()
+        return dict(body, ResponseMetadata={'HTTPStatusCode': status})
+
+    def _delay(self):
+        time.sleep(args.latency_ms / 1000)
+
+    def _function(self, name):
+        if name not in self.functions:
+            raise self.exceptions.ResourceNotFoundException(name)
+        return self.functions[name]
+
+    def create_function(self, FunctionName, Runtime, Handler='lambda_function.lambda_handler', **kwargs):
+        self.functions[FunctionName] = {
+            'FunctionName': FunctionName,
+            'FunctionArn': f'arn:aws:lambda:{region}:{account_id}:function:{FunctionName}',
+            'Runtime': Runtime,
+            'Handler': Handler,
+            'CodeSha256': '',
+            'Version': '$LATEST',
+            'Layers': []
+        }
+
+    def get_function_configuration(self, FunctionName, **kwargs):
+        return self._response(**self._function(FunctionName))
+
+    def update_function_configuration(self, FunctionName, Layers=None, **kwargs):
+        config = self._function(FunctionName)
+        if Layers is not None:
+            config['Layers'] = [{'Arn': arn} for arn in Layers]
+        return self._response(**config)
+
+    def update_function_code(self, FunctionName, S3Bucket, S3Key, **kwargs):
+        config = self._function(FunctionName)
+        code = self.s3.objects[(S3Bucket, S3Key)]
+        config['CodeSha256'] = b64encode(sha256(code).digest()).decode()
+        return self._response(**config)
+
+    def publish_version(self, FunctionName, CodeSha256='', **kwargs):
+        config = self._function(FunctionName)
+        with self.lock:
+            self.versions.append(dict(config))
+            version = str(len(self.versions))
+        return self._response(**dict(config, Version=version))
+
+    def publish_layer_version(self, LayerName, Content, **kwargs):
+        if 'S3Key' in Content and (Content['S3Bucket'], Content['S3Key']) not in self.s3.objects:
+            return self._response(status=400)
+        with self.lock:
+            versions = self.layers.setdefault(LayerName, [])
+            versions.append(dict(kwargs, Content=Content))
+            arn = f'arn:aws:lambda:{region}:{account_id}:layer:{LayerName}:{len(versions)}'
+        return self._response(status=201, LayerVersionArn=arn, Version=len(versions))
+
+    def get_layer_version_by_arn(self, Arn):
+        name, version = Arn.split(':')[-2:]
+        if int(version) > len(self.layers.get(name, [])):
+            raise self.exceptions.ResourceNotFoundException(Arn)
+        return self._response(LayerVersionArn=Arn, Version=int(version))
+
+    def get_alias(self, FunctionName, Name):
+        if (FunctionName, Name) not in self.aliases:
+            raise self.exceptions.ResourceNotFoundException(Name)
+        return self._response(Name=Name, FunctionVersion=self.aliases[(FunctionName, Name)])
+
+    def create_alias(self, FunctionName, Name, FunctionVersion='$LATEST', **kwargs):
+        self.aliases[(FunctionName, Name)] = FunctionVersion
+        return self._response(status=201, Name=Name, FunctionVersion=FunctionVersion)
+
+    def update_alias(self, FunctionName, Name, FunctionVersion='$LATEST', **kwargs):
+        self.aliases[(FunctionName, Name)] = FunctionVersion
+        return self._response(Name=Name, FunctionVersion=FunctionVersion)
+
+
+def moto_clients():
+    """Starts moto and creates the deployment bucket and the target function"""
+    import boto3
+    try:
+        from moto import mock_aws
+        mock = mock_aws()
+    except ImportError:
+        from moto import mock_iam, mock_lambda, mock_s3
+        mock = [mock_iam(), mock_lambda(), mock_s3()]
+    for m in mock if isinstance(mock, list) else [mock]:
+        m.start()
+    s3 = boto3.client('s3', region_name=region)
+    s3.create_bucket(Bucket=os.environ['deploy_bucket'])
+    return s3, boto3.client('lambda', region_name=region)
+
+
+def create_function(s3, lambda_client):
+    """Creates the function that the benchmark deploys to"""
+    if isinstance(lambda_client, StubLambda):
+        lambda_client.create_function(function_name, 'python{}.{}'.format(*sys.version_info[:2]))
+        return
+    import boto3
+    import zipfile
+    iam = boto3.client('iam', region_name=region)
+    role = iam.create_role(RoleName=function_name, AssumeRolePolicyDocument='{}', Path='/service-role/')
+    package = io.BytesIO()
+    with zipfile.ZipFile(package, 'w') as f:
+        f.writestr('lambda_function.py', 'def lambda_handler(event, context):\n    return event\n')
+    lambda_client.create_function(
+        FunctionName=function_name,
+        Runtime='python{}.{}'.format(*sys.version_info[:2]),
+        Role=role['Role']['Arn'],
+        Handler='lambda_function.lambda_handler',
+        Code={'ZipFile': package.getvalue()}
+    )
+
+
+def write_file(path, size, rng, text=True):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        if text:
+            line = '# {}\n'.format('x' * 60)
+            body = 'VALUE = {}\n'.format(rng.random()) + line * (size // len(line) + 1)
+            f.write(body[:size].encode())
+        else:
+            f.write(bytes(rng.getrandbits(8) for _ in range(size)) if size < 65536 else os.urandom(size))
+
+
+def commit_all(path, message):
+    repo = Repo(path)
+    paths = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if d != '.git']
+        paths += [os.path.join(root, f) for f in files]
+    porcelain.add(repo, paths)
+    porcelain.commit(repo, message=message.encode(), author=b'bench <bench@example.com>',
+                     committer=b'bench <bench@example.com>')
+
+
+def create_repositories(port):
+    """Generates the function repository and its editable dependencies"""
+    rng = random.Random(0)
+    repos_dir = os.path.join(work_dir, 'repos')
+    rmtree(repos_dir, ignore_errors=True)
+    repos = {}
+    requirements = []
+    for i in range(args.editable):
+        name = f'pkg{i}'
+        path = os.path.join(repos_dir, name)
+        os.makedirs(path)
+        porcelain.init(path)
+        write_file(os.path.join(path, name, '__init__.py'), 4096, rng)
+        for j in range(10):
+            write_file(os.path.join(path, name, f'module{j}.py'), 4096, rng)
+        with open(os.path.join(path, 'setup.py'), 'w') as f:
+            f.write(f"from setuptools import setup\nsetup(name='{name}', packages=['{name}'])\n")
+        commit_all(path, f'create {name}')
+        repos[f'/{username}/{name}.git'] = path
+        requirements.append(f'-e git+git://127.0.0.1:{port}/{username}/{name}.git#egg={name}')
+
+    path = os.path.join(repos_dir, function_name)
+    os.makedirs(path)
+    porcelain.init(path)
+    with open(os.path.join(path, 'lambda_function.py'), 'w') as f:
+        f.write('def lambda_handler(event, context):\n    return {"statusCode": 200}\n')
+    for i in range(args.files):
+        write_file(os.path.join(path, 'src', f'module{i}.py'), args.file_size * 1024, rng)
+    with open(os.path.join(path, 'requirements.txt'), 'w') as f:
+        f.write('\n'.join(requirements) + '\n')
+    layers = {'dependencies': ['requirements.txt']}
+    for i in range(args.layers):
+        for j in range(args.layer_size):
+            write_file(os.path.join(path, f'data{i}', f'blob{j}.bin'), 1024 * 1024, rng, text=not args.random_data)
+        layers[f'data{i}'] = {'description': f'synthetic data layer {i}', 'files': [f'data{i}']}
+    build_config = {
+        'function': {'runtimes': ['python{}.{}'.format(*sys.version_info[:2])], 'files': ['lambda_function.py', 'src']},
+        'layers': layers
+    }
+    with open(os.path.join(path, 'build.json'), 'w') as f:
+        json.dump(build_config, f, indent=2)
+    commit_all(path, 'create function')
+    repos[f'/{username}/{function_name}.git'] = path
+    return {url: Repo(p) for url, p in repos.items()}, path
+
+
+def clean_tmp():
+    """Removes everything a previous build left in /tmp, as on a cold container"""
+    for path in [f'/tmp/{function_name}', f'/tmp/venvs/{function_name}', '/tmp/editable', '/tmp/wheels', '/tmp/build']:
+        rmtree(path, ignore_errors=True)
+    for name in os.listdir('/tmp'):
+        if name.startswith('build-'):
+            rmtree(os.path.join('/tmp', name), ignore_errors=True)
+
+
+def run_build(lambda_function, log):
+    """Invokes lambda_handler once and returns its measurements"""
+    tmp_before = disk_usage('/tmp').used
+    start = time.time()
+    with redirect_stdout(log):
+        response = lambda_function.lambda_handler({
+            'action': 'build',
+            'function': function_name,
+            'repo_name': function_name,
+            'build_file': 'build.json',
+            'version': 'true'
+        }, None)
+    elapsed = (time.time() - start) * 1000
+    if response.get('statusCode') != 200:
+        sys.exit('build failed: {}'.format(response.get('body')))
+    trace = response['trace']
+    phases = {}
+    for record in trace['phases']:
+        phases[record['phase']] = phases.get(record['phase'], 0) + record['duration_ms']
+    return {
+        'total_ms': elapsed,
+        'phases': phases,
+        'peak_rss_mb': trace['peak_rss_mb'],
+        'tmp_mb': max(0, trace['peak_tmp_used_mb'] - tmp_before / 1024 / 1024)
+    }
+
+
+def summarize(runs):
+    """Reduces repeated runs of a scenario to their medians"""
+    phases = sorted(set(p for run in runs for p in run['phases']))
+    return {
+        'total_ms': round(statistics.median(r['total_ms'] for r in runs), 1),
+        'phases': {p: round(statistics.median(r['phases'].get(p, 0) for r in runs), 1) for p in phases},
+        'peak_rss_mb': max(r['peak_rss_mb'] for r in runs),
+        'tmp_mb': round(max(r['tmp_mb'] for r in runs), 1)
+    }
+
+
+def compare(results, baseline):
+    """Prints each measurement next to the baseline and returns the regressions beyond the tolerance"""
+    regressions = []
+    for scenario, result in results.items():
+        base = baseline.get('results', {}).get(scenario, {})
+        rows = [('total', result['total_ms'], base.get('total_ms'))]
+        rows += [(p, ms, base.get('phases', {}).get(p)) for p, ms in result['phases'].items()]
+        rows += [('peak RSS (MB)', result['peak_rss_mb'], base.get('peak_rss_mb'))]
+        rows += [('/tmp footprint (MB)', result['tmp_mb'], base.get('tmp_mb'))]
+        print(f'\n{scenario}')
+        for name, value, previous in rows:
+            change = ''
+            if previous:
+                pct = (value - previous) / previous * 100
+                change = f'{pct:+.1f}%'
+                # ignore sub-50ms noise in short phases
+                if pct > args.tolerance and value - previous > (50 if 'MB' not in name else 1):
+                    regressions.append(f'{scenario}: {name} {previous} -> {value} ({change})')
+                    change += ' REGRESSION'
+            print('  {:<32} {:>12} {:>12} {}'.format(name, value, previous if previous is not None else '-', change))
+    return regressions
+
+
+def main():
+    os.makedirs(work_dir, exist_ok=True)
+    git_repos = {}
+    server = TCPGitServer(BenchmarkBackend(git_repos), '127.0.0.1', 0)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ['git_base_url'] = f'git://127.0.0.1:{port}'
+
+    repos, function_repo = create_repositories(port)
+    git_repos.update(repos)
+
+    import lambda_function
+    scenarios = ['cold', 'warm, no changes', 'warm, code change']
+    results = {s: [] for s in scenarios}
+    with open(args.log, 'w') as log:
+        for run in range(args.runs):
+            clean_tmp()
+            if args.moto:
+                s3, lambda_client = moto_clients()
+            else:
+                s3 = StubS3()
+                lambda_client = StubLambda(s3)
+            create_function(s3, lambda_client)
+            lambda_function.s3_client = s3
+            lambda_function.lambda_client = lambda_client
+            for scenario in scenarios:
+                if scenario == 'warm, code change':
+                    with open(os.path.join(function_repo, 'src', 'module0.py'), 'a') as f:
+                        f.write(f'CHANGE = {run}\n')
+                    commit_all(function_repo, f'change {run}')
+                print(f'run {run + 1}/{args.runs}: {scenario}', file=sys.stderr)
+                results[scenario].append(run_build(lambda_function, log))
+    server.shutdown()
+
+    results = {scenario: summarize(runs) for scenario, runs in results.items()}
+    parameters = {k: v for k, v in vars(args).items() if k not in ['baseline', 'save_baseline', 'tolerance', 'log']}
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+    if baseline and baseline.get('parameters') != parameters:
+        print(f'warning: {args.baseline} was recorded with different parameters', file=sys.stderr)
+    regressions = compare(results, baseline)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'parameters': parameters, 'results': results}, f, indent=2, sort_keys=True)
+        print(f'\nsaved baseline to {args.baseline}')
+    elif regressions:
+        print('\nregressions beyond {}%:\n  {}'.format(args.tolerance, '\n  '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""Runs the builder as a long-lived local or self-hosted build server.
+
+Build requests are the same events that the Lambda function takes, posted as JSON to /builds.  They are queued and run
+by a pool of worker processes, each of which imports lambda_function once and keeps its checkouts, virtualenvs and wheel
+cache in /tmp between builds, like a warm Lambda container.  Builds of the same repository never run at the same time,
+and a request for a repository, branch and set of functions that is already waiting in the queue is merged into the
+waiting build, which then builds the latest commit once.  Each build's status, phase timings and output can be polled:
+
+    POST /builds                   queue a build, returns its id
+    GET  /builds                   list builds
+    GET  /builds/<id>?wait=<s>     status, phase timings and response, optionally waiting for the build to finish
+    GET  /builds/<id>/log          build output
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+repo_root = os.path.dirname(os.path.abspath(__file__))
+log_dir = '/tmp/build-server'
+
+
+def run_job(event, log_path):
+    """Runs one build in a worker process, writing its output to log_path, and returns the handler response"""
+    import lambda_function
+    with open(log_path, 'a', buffering=1) as log, redirect_stdout(log):
+        return lambda_function.lambda_handler(event, None)
+
+
+def job_key(event):
+    """Returns the key under which queued requests are merged: the action, repository, branch and functions"""
+    return json.dumps([
+        event.get('action'),
+        event.get('repo_name'),
+        event.get('branch', ''),
+        event.get('functions', event.get('function'))
+    ], sort_keys=True)
+
+
+def log_phases(log_path):
+    """Returns the trace records that a running build has logged so far"""
+    phases = []
+    try:
+        with open(log_path) as f:
+            for line in f:
+                if line.startswith('{') and '"_aws"' in line:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    record.pop('_aws', None)
+                    phases.append(record)
+    except FileNotFoundError:
+        pass
+    return phases
+
+
+class BuildQueue(object):
+    """Queues builds and hands them to a pool of worker processes, at most one build per repository at a time"""
+
+    def __init__(self, workers, history=100):
+        self.condition = threading.Condition()
+        self.jobs = {}
+        self.queue = []
+        self.running = set()
+        self.idle = workers
+        self.history = history
+        self.workers = workers
+        self.executor = self.start_workers()
+
+    def start_workers(self):
+        # spawned workers import lambda_function fresh instead of inheriting the server's threads
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, event):
+        """Queues a build, or merges it into a queued build of the same key; returns the job and whether it merged"""
+        key = job_key(event)
+        with self.condition:
+            for job_id in self.queue:
+                job = self.jobs[job_id]
+                if job['key'] == key:
+                    # the merged build fetches the branch when it starts, so it picks up the latest commit anyway
+                    force = job['event'].get('force', False) or event.get('force', False)
+                    job['event'] = dict(event, force=force)
+                    job['requests'] += 1
+                    return job, True
+            job_id = uuid.uuid4().hex
+            job = {
+                'id': job_id,
+                'status': 'queued',
+                'key': key,
+                'lock': event.get('repo_name', event['action']),
+                'event': event,
+                'requests': 1,
+                'queued_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'log': os.path.join(log_dir, f'{job_id}.log'),
+                'response': None
+            }
+            self.jobs[job_id] = job
+            self.queue.append(job_id)
+            self.dispatch()
+            self.expire()
+            return job, False
+
+    def dispatch(self):
+        """Starts queued builds, oldest first, while workers are idle and their repositories are not being built"""
+        for job_id in list(self.queue):
+            if not self.idle:
+                break
+            job = self.jobs[job_id]
+            if job['lock'] in self.running:
+                continue
+            self.queue.remove(job_id)
+            self.running.add(job['lock'])
+            self.idle -= 1
+            job['status'] = 'running'
+            job['started_at'] = time.time()
+            print('starting build {} of {}'.format(job_id, job['key']))
+            try:
+                future = self.executor.submit(run_job, job['event'], job['log'])
+            except BrokenProcessPool:
+                # a worker died, for instance when it ran out of memory, which breaks the whole pool
+                self.executor = self.start_workers()
+                future = self.executor.submit(run_job, job['event'], job['log'])
+            future.add_done_callback(lambda f, job=job: self.finished(job, f))
+
+    def finished(self, job, future):
+        with self.condition:
+            try:
+                response = future.result()
+            except Exception as e:
+                response = {'statusCode': 500, 'body': '{}: {}'.format(type(e).__name__, e)}
+            status = response.get('statusCode', response.get('status', 200))
+            job['response'] = response
+            job['status'] = 'succeeded' if status == 200 else 'failed'
+            job['finished_at'] = time.time()
+            print('build {} {} in {:.1f} s'.format(job['id'], job['status'], job['finished_at'] - job['started_at']))
+            self.running.discard(job['lock'])
+            self.idle += 1
+            self.dispatch()
+            self.condition.notify_all()
+
+    def expire(self):
+        """Forgets the oldest finished builds beyond the history limit"""
+        finished = sorted((j for j in self.jobs.values() if j['finished_at']), key=lambda j: j['finished_at'])
+        for job in finished[:max(len(finished) - self.history, 0)]:
+            del self.jobs[job['id']]
+            try:
+                os.remove(job['log'])
+            except FileNotFoundError:
+                pass
+
+    def status(self, job_id, wait=0):
+        """Returns the status of a build, waiting up to wait seconds for it to finish, or None if it is unknown"""
+        deadline = time.time() + wait
+        with self.condition:
+            job = self.jobs.get(job_id)
+            while job and not job['finished_at'] and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            if not job:
+                return None
+            status = {k: v for k, v in job.items() if k not in ['key', 'lock', 'log']}
+        if status['response'] and 'trace' in status['response']:
+            status['phases'] = status['response']['trace']['phases']
+        else:
+            status['phases'] = log_phases(job['log'])
+        if status['started_at']:
+            status['duration_s'] = round((status['finished_at'] or time.time()) - status['started_at'], 1)
+        return status
+
+    def list(self):
+        with self.condition:
+            return [
+                {k: job[k] for k in ['id', 'status', 'requests', 'queued_at', 'started_at', 'finished_at']}
+                for job in self.jobs.values()
+            ]
+
+
+class BuildRequestHandler(BaseHTTPRequestHandler):
+    queue = None
+
+    def reply(self, code, body):
+        data = json.dumps(body, default=str).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/builds':
+            return self.reply(404, {'message': 'not found'})
+        try:
+            event = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(event, dict) or 'action' not in event:
+                raise ValueError('a build request needs an action')
+        except ValueError as e:
+            return self.reply(400, {'message': str(e)})
+        job, merged = self.queue.submit(event)
+        self.reply(202, {'id': job['id'], 'status': job['status'], 'merged': merged})
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        parts = path.strip('/').split('/')
+        if parts == ['builds']:
+            return self.reply(200, self.queue.list())
+        if len(parts) < 2 or parts[0] != 'builds':
+            return self.reply(404, {'message': 'not found'})
+        params = dict(p.partition('=')[::2] for p in query.split('&') if p)
+        try:
+            wait = min(float(params.get('wait', 0)), 300)
+        except ValueError:
+            return self.reply(400, {'message': 'wait must be a number of seconds'})
+        status = self.queue.status(parts[1], wait if parts[2:] != ['log'] else 0)
+        if not status:
+            return self.reply(404, {'message': f'no build {parts[1]}'})
+        if parts[2:] == ['log']:
+            try:
+                with open(os.path.join(log_dir, f'{parts[1]}.log'), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = b''
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            return self.wfile.write(data)
+        self.reply(200, status)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=2, help='number of builds that can run at the same time')
+    parser.add_argument('--history', type=int, default=100, help='number of finished builds to keep')
+    args = parser.parse_args()
+
+    # the variables that Lambda provides; deploy_bucket, git_username and AWS credentials must be set by the caller
+    os.environ.setdefault('LAMBDA_TASK_ROOT', repo_root)
+    os.environ.setdefault('AWS_EXECUTION_ENV', 'AWS_Lambda_python{}.{}'.format(*sys.version_info[:2]))
+    os.environ.setdefault('AWS_LAMBDA_FUNCTION_NAME', 'lambda-lambda-lambda')
+    missing = [v for v in ['AWS_REGION', 'deploy_bucket', 'git_username'] if v not in os.environ]
+    if missing:
+        sys.exit('please set {}'.format(', '.join(missing)))
+    os.makedirs(log_dir, exist_ok=True)
+
+    BuildRequestHandler.queue = BuildQueue(args.workers, args.history)
+    server = ThreadingHTTPServer((args.host, args.port), BuildRequestHandler)
+    print(f'listening on {args.host}:{args.port} with {args.workers} workers')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        BuildRequestHandler.queue.executor.shutdown(wait=True, cancel_futures=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,12 +17,14 @@ done
 FUNCTION="$(basename "$( cd -P "$( dirname "$SOURCE" )" && pwd )")"
 REPO="$FUNCTION"
 LOG_FILE="deploy.log"
+FORCE=
 PROMPT=true
+SERVER=
 TIME=
 VERSION=
 
 usage() {
-    echo "Usage: $0 [ -a ALIAS ][ -b GIT_BRANCH ] [ -c CONFIG_FILE ] [ -f FUNCTION_NAME ] [ -g GIT_REPO ] [ -l LOG_FILE] [ -p AWS_PROFILE ] [ -r AWS_REGION ] [ -t ] [ -v ][ -y ] [function|dependencieslayer]" 1>&2
+    echo "Usage: $0 [ -a ALIAS ][ -b GIT_BRANCH ] [ -c CONFIG_FILE ] [ -f FUNCTION_NAME ] [ -F ] [ -g GIT_REPO ] [ -l LOG_FILE] [ -p AWS_PROFILE ] [ -r AWS_REGION ] [ -s BUILD_SERVER ] [ -t ] [ -v ][ -y ] [function|dependencieslayer]" 1>&2
 }
 
 exit_abnormal() {
@@ -31,7 +33,7 @@ exit_abnormal() {
 }
 
 # parse command line arguments
-args=$(getopt a:b:c:f:g:l:p:r:tvy $*)
+args=$(getopt a:b:c:f:Fg:l:p:r:s:tvy $*)
 [ $? -ne 0 ] && exit_abnormal
 eval set -- "$args"
 while true; do
@@ -44,6 +46,8 @@ while true; do
             CONFIG_FILE=$2; shift 2 ;;
         -f)
             FUNCTION=$2; shift 2 ;;
+        -F)
+            FORCE=", \"force\": true"; shift ;;
         -g)
             REPO=$2; shift 2 ;;
         -l)
@@ -52,6 +56,8 @@ while true; do
             AWS_PROFILE=$2; shift 2 ;;
         -r)
             AWS_REGION=$2; shift 2 ;;
+        -s)
+            SERVER=$2; shift 2 ;;
         -t)
             TIME="time"; shift ;;
         -v)
@@ -84,6 +90,10 @@ if [[ "$args" != *" -l"* ]]; then
     TEMP="$(grep -i LOG_FILE $CONFIG_FILE | sed 's/.* = //')"
     [ ! -z "$TEMP" ] && LOG_FILE="$TEMP"
 fi
+if [[ "$args" != *" -s"* ]]; then
+    TEMP="$(grep -i BUILD_SERVER $CONFIG_FILE | sed 's/.* = //')"
+    [ ! -z "$TEMP" ] && SERVER="$TEMP"
+fi
 if [[ "$args" != *" -y"* ]]; then
     TEMP="$(grep -i PROMPT_BEFORE_DEPLOY $CONFIG_FILE | sed 's/.* = //' | tr '[:upper:]' '[:lower:]')"
     [ ! -z "$TEMP" ] && PROMPT="$TEMP"
@@ -144,12 +154,39 @@ else
     B64=$(which tee)
 fi
 
+# several comma-separated functions are built from one checkout
+if [[ "$FUNCTION" == *,* ]]; then
+    TARGET="\"functions\": [\"${FUNCTION//,/\", \"}\"]"
+else
+    TARGET="\"function\": \"${FUNCTION}\""
+fi
+
+PAYLOAD="{\"action\": \"${ACTION}\", \"branch\": \"${BRANCH}\", ${TARGET}, \"repo_name\": \"${REPO}\"${VERSION}${ALIAS}${FORCE}}"
+
+# queue the build on a build server and wait for it to finish
+if [ ! -z "$SERVER" ]; then
+    JOB="$(curl -sf -X POST --data "$PAYLOAD" "${SERVER}/builds" | sed 's/.*"id": "\([0-9a-f]*\)".*/\1/')"
+    if [ -z "$JOB" ]; then
+        echo "Could not queue the build on $SERVER"
+        exit 1
+    fi
+    echo "Queued build $JOB"
+    STATUS=
+    until [[ "$STATUS" == "{\"id\": \"${JOB}\", \"status\": \"succeeded\""* || "$STATUS" == "{\"id\": \"${JOB}\", \"status\": \"failed\""* ]]; do
+        STATUS="$(curl -sf "${SERVER}/builds/${JOB}?wait=60")" || exit 1
+    done
+    echo "$STATUS" > $LOG_FILE
+    curl -sf "${SERVER}/builds/${JOB}/log"
+    [[ "$STATUS" == "{\"id\": \"${JOB}\", \"status\": \"succeeded\""* ]]
+    exit
+fi
+
 # build and deploy the Lambda function
 $TIME aws lambda invoke \
     --invocation-type RequestResponse \
     --function-name lambda-lambda-lambda \
     --region $AWS_REGION \
     --log-type Tail \
-    --payload "{\"action\": \"${ACTION}\", \"branch\": \"${BRANCH}\", \"function\": \"${FUNCTION}\", \"repo_name\": \"${REPO}\"${VERSION}${ALIAS}}" \
+    --payload "$PAYLOAD" \
     --profile $AWS_PROFILE \
     $LOG_FILE | eval $JQ | eval $B64
@@ -2,56 +2,213 @@
 
 runtime="$(echo $AWS_EXECUTION_ENV | sed 's/AWS_Lambda_//')"
 repo_name="$1"
-requirements="$2"
+shift
+build_dir="${BUILD_DIR:-/tmp/build}"
+# each set of requirements files that is installed together has a virtualenv of its own
+venv="${VENV_DIR:-/tmp/${repo_name}/venv}"
 if [ ! -d "/tmp/${repo_name}" ]; then
   echo "/tmp/${repo_name} does not exist"
   exit 1
 fi
-if [ ! -f "/tmp/${repo_name}/${requirements}" ]; then
-  echo "/tmp/${repo_name}/${requirements} does not exist"
-  exit 1
-fi
+for requirements in "$@"; do
+  if [ ! -f "/tmp/${repo_name}/${requirements}" ]; then
+    echo "/tmp/${repo_name}/${requirements} does not exist"
+    exit 1
+  fi
+done
+
+source "$(dirname "${BASH_SOURCE[0]}")/wheel_cache.sh"
+
+# exclude editable, vendored, testing, and documentation modules
+filter_requirements() {
+  sed -i '/^-e/d' "$1"
+  sed -i '/^alabaster/d' "$1"
+  sed -i '/^autodoc/d' "$1"
+  sed -i '/^apilogs/d' "$1"
+  sed -i '/^awslogs/d' "$1"
+  sed -i '/^Babel/d' "$1"
+  sed -i '/^boto/d' "$1"
+  sed -i '/^colored==/d' "$1"
+  sed -i '/^docutils/d' "$1"
+  sed -i '/^flake8/d' "$1"
+  sed -i '/^jmespath/d' "$1"
+  sed -i '/^mccabe/d' "$1"
+  sed -i '/^pip/d' "$1"
+  sed -i '/^pycodestyle/d' "$1"
+  sed -i '/^pyflakes/d' "$1"
+  sed -i '/^python-lambda-local/d' "$1"
+  sed -i '/^Pygments/d' "$1"
+  sed -i '/^s3transfer/d' "$1"
+  sed -i '/^setuptools/d' "$1"
+  sed -i '/^[sS]phinx/d' "$1"
+  sed -i '/^termcolor/d' "$1"
+  sed -i '/^WebTest/d' "$1"
+}
 
 cd "/tmp/${repo_name}" || exit
-rm -rf venv
-echo "$(date) creating virtualenv..."
-echo "$(python --version)"
-python -m venv venv
-source venv/bin/activate
-pip install --no-cache-dir --upgrade pip
-base_virtualenv_files="$(ls venv/lib/${runtime}/site-packages)"
+# the requirements are filtered in copies, since several runtimes may be installed from the same file at once, and the
+# copies are kept outside the checkout, which function packages are archived from while this runs
+mkdir -p "/tmp/${repo_name}-tmp"
+files=()
+trap 'rm -f "${files[@]}"' EXIT
+requirements=()
+for original in "$@"; do
+  filtered="$(mktemp -p "/tmp/${repo_name}-tmp" requirements.XXXXXX)"
+  files+=("$filtered")
+  cp "$original" "$filtered"
+  filter_requirements "$filtered"
+  # pip finds the files that a requirements file includes, such as -r base.txt, relative to it, so the copy's
+  # includes are made absolute
+  original_dir="${PWD}/$(dirname "$original")"
+  sed -i -E "/:\/\//! s#^(-r|-c|--requirement|--constraint)[ =]+([^/ ])#\1 ${original_dir}/\2#" "$filtered"
+  requirements+=(-r "$filtered")
+done
+# the versions that the requirements were resolved to for the cache key are installed, rather than whatever the wheel
+# cache happens to satisfy them with, and they are part of the fingerprint of the virtualenv
+if [ -n "$CONSTRAINTS" ] && [ -n "${files[0]}" ]; then
+  printf '\n-c %s\n' "$CONSTRAINTS" >> "${files[0]}"
+fi
+
+target=()
+install_target=()
+if [ -n "$TARGET_RUNTIME" ]; then
+  target=(--implementation cp --python-version "${TARGET_RUNTIME#python}" --only-binary :all:)
+  # pip only accepts wheels tagged with one of the listed platforms, so every compatible manylinux tag is passed
+  for tag in $TARGET_PLATFORM; do
+    target+=(--platform "$tag")
+  done
+  # pip install only takes platform options along with --target
+  install_target=(--target "${build_dir}/python" "${target[@]}")
+fi
+
+# only report the versions that pip resolves the requirements to, without installing anything
+if [ -n "$RESOLVE_REPORT" ]; then
+  python -m pip --no-cache-dir install --dry-run --ignore-installed --quiet --report "$RESOLVE_REPORT" \
+    --find-links "$wheel_cache" "${install_target[@]}" "${requirements[@]}"
+  exit
+fi
+
+# wheels for another runtime are installed straight into the layer, since there is no interpreter to make a venv with
+if [ -n "$TARGET_RUNTIME" ]; then
+  echo "$(date) installing dependencies for ${TARGET_RUNTIME} (${TARGET_PLATFORM%% *})..."
+  python -m pip --no-cache-dir install --no-index --find-links "$wheel_cache" "${install_target[@]}" \
+    "${requirements[@]}" 2> /dev/null && exit
+  echo "$(date) downloading wheels missing from cache..."
+  python -m pip --no-cache-dir download --find-links "$wheel_cache" --dest "$wheel_cache" "${target[@]}" \
+    "${requirements[@]}" || exit
+  python -m pip --no-cache-dir install --no-index --find-links "$wheel_cache" "${install_target[@]}" \
+    "${requirements[@]}"
+  exit
+fi
+
+# a warm container keeps the virtualenv of its last build, tagged with the interpreter that created it
+interpreter="${runtime} $(python --version 2>&1)"
+if [ -x "${venv}/bin/python" ] && [ "$(cat "${venv}/.interpreter" 2> /dev/null)" == "$interpreter" ]; then
+  echo "$(date) reusing virtualenv..."
+  source "${venv}/bin/activate"
+else
+  rm -rf "$venv"
+  echo "$(date) creating virtualenv..."
+  echo "$(python --version)"
+  python -m venv "$venv"
+  source "${venv}/bin/activate"
+  upgrade_pip
+  ls "${venv}/lib/${runtime}/site-packages" > "${venv}/.base-files"
+  echo "$interpreter" > "${venv}/.interpreter"
+fi
 # separate editable packages
-mkdir -p venv/src
-rm -rf venv/src/*
-# exclude editable, vendored, testing, and documentation modules
-sed -i '/^-e/d' "$requirements"
-sed -i '/^alabaster/d' "$requirements"
-sed -i '/^autodoc/d' "$requirements"
-sed -i '/^apilogs/d' "$requirements"
-sed -i '/^awslogs/d' "$requirements"
-sed -i '/^Babel/d' "$requirements"
-sed -i '/^boto/d' "$requirements"
-sed -i '/^colored==/d' "$requirements"
-sed -i '/^docutils/d' "$requirements"
-sed -i '/^flake8/d' "$requirements"
-sed -i '/^jmespath/d' "$requirements"
-sed -i '/^mccabe/d' "$requirements"
-sed -i '/^pip/d' "$requirements"
-sed -i '/^pycodestyle/d' "$requirements"
-sed -i '/^pyflakes/d' "$requirements"
-sed -i '/^python-lambda-local/d' "$requirements"
-sed -i '/^Pygments/d' "$requirements"
-sed -i '/^s3transfer/d' "$requirements"
-sed -i '/^setuptools/d' "$requirements"
-sed -i '/^[sS]phinx/d' "$requirements"
-sed -i '/^termcolor/d' "$requirements"
-sed -i '/^WebTest/d' "$requirements"
-echo "$(date) installing dependencies..."
-pip --no-cache-dir install -r "$requirements"
+mkdir -p "${venv}/src"
+rm -rf "${venv}"/src/*
+
+# prints a fingerprint of the requirements, or the installed distributions they no longer need, following -r and -c
+inspect_requirements() {
+  python - "$1" "${files[@]}" << 'EOF'
+import hashlib
+import os
+import sys
+
+includes = [('--requirement', False), ('--constraint', True), ('-r', False), ('-c', True)]
+
+
+def read(path, constraint=False):
+    with open(path) as f:
+        for line in f:
+            line = line.split(' #')[0].strip()
+            for option, is_constraint in includes:
+                if line.startswith(option):
+                    # includes are relative to the file that contains them
+                    name = line[len(option):].lstrip(' =')
+                    yield from read(os.path.join(os.path.dirname(path), name), constraint or is_constraint)
+                    break
+            else:
+                if line and not line.startswith('#'):
+                    yield line, constraint
+
+
+try:
+    lines = [line for path in sys.argv[2:] for line in read(path)]
+except OSError:
+    # a URL include could need anything, so it never counts as unchanged and nothing is removed
+    sys.exit()
+if sys.argv[1] == 'fingerprint':
+    print(hashlib.sha256(repr(sorted(lines)).encode()).hexdigest())
+    sys.exit()
+
+from importlib import metadata
+from pip._vendor.packaging.requirements import InvalidRequirement, Requirement
+from pip._vendor.packaging.utils import canonicalize_name
+
+installed = {canonicalize_name(d.metadata['Name']): d for d in metadata.distributions()}
+try:
+    pending = [(Requirement(line), '') for line, constraint in lines if not (constraint or line.startswith('-'))]
+except InvalidRequirement:
+    # a URL or path requirement could need anything, so nothing is removed
+    sys.exit()
+needed = set()
+while pending:
+    requirement, extra = pending.pop()
+    if requirement.marker and not requirement.marker.evaluate({'extra': extra}):
+        continue
+    name = canonicalize_name(requirement.name)
+    for extra in [''] + sorted(requirement.extras):
+        if name in installed and (name, extra) not in needed:
+            needed.add((name, extra))
+            pending += [(Requirement(r), extra) for r in installed[name].requires or []]
+print(' '.join(sorted(set(installed) - {name for name, _ in needed} - {'pip', 'setuptools', 'wheel'})))
+EOF
+}
+
+# the requirements are only installed if they or the virtualenv changed since the last install into it, since a
+# preinstall command may have installed other packages into it
+site_packages="${venv}/lib/${runtime}/site-packages"
+fingerprint="$(inspect_requirements fingerprint)"
+if [ -n "$fingerprint" ] && \
+  [ "$(cat "${venv}/.requirements" 2> /dev/null)" == "$fingerprint $(ls -A "$site_packages" | sha256sum)" ]; then
+  echo "$(date) requirements unchanged, skipping install"
+else
+  echo "$(date) installing dependencies..."
+  rm -f "${venv}/.requirements"
+  if [ ${#requirements[@]} -gt 0 ]; then
+    cached_install "${requirements[@]}" || exit
+  fi
+  # remove distributions that are no longer required, either directly or by another requirement
+  stale="$(inspect_requirements stale)"
+  if [ -n "$stale" ]; then
+    echo "$(date) removing ${stale}..."
+    pip uninstall --yes $stale
+  fi
+  echo "$fingerprint $(ls -A "$site_packages" | sha256sum)" > "${venv}/.requirements"
+fi
 deactivate
-cd "venv/lib/${runtime}/site-packages/" || exit
-cp -a . /tmp/build/python/
+# only the virtualenv is needed when a layer's preinstall commands use it but the dependencies layer is not staged
+if [ -n "$VENV_ONLY" ]; then
+  exit
+fi
+echo "$(date) copying site-packages to build directory..."
+cd "$site_packages" || exit
+# hard links stage the packages without copying their contents
+cp -al . "${build_dir}/python/" 2> /dev/null || cp -a . "${build_dir}/python/"
 # delete modules that were not explicitly listed in requirements.txt, to minimize layer size
-for file in $base_virtualenv_files; do
-  rm -rf /tmp/build/python/${file}
+for file in $(cat "${venv}/.base-files"); do
+  rm -rf "${build_dir}/python/${file}"
 done
@@ -16,7 +16,8 @@ from shutil import rmtree
 if LooseVersion(awscli.__version__) < LooseVersion('1.9.57'):
     sys.exit('AWS CLI version 1.9.57 or greater is required')
 
-deploy_files = ["build_package.sh", "install_requirements.sh", "lambda_function.py", "setup_git.sh"]
+deploy_files = ["build_package.sh", "install_requirements.sh", "lambda_function.py", "setup_git.sh",
+                "wheel_cache.sh"]
 
 configparser = ConfigParser()
 configparser.read('config.ini')
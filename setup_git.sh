@@ -5,18 +5,30 @@ if [ -z $runtime ]; then
   echo "could not determine runtime"
   exit 1
 fi
+source "$(dirname "${BASH_SOURCE[0]}")/wheel_cache.sh"
+
 cd /tmp || exit 1
 rm -rf build
 mkdir -p build/python
 echo "creating virtualenv..."
 $runtime -m venv venv
 source venv/bin/activate
-pip --no-cache-dir install --upgrade pip
+upgrade_pip
 base_virtualenv_files="$(ls venv/lib/${runtime}/site-packages)"
 echo "installing dependencies..."
-pip --no-cache-dir install urllib3 certifi PyYAML
-# dependencies above must be installed before using the --pure option
-pip --no-cache-dir install dulwich --global-option="--pure"
+cached_install urllib3 certifi PyYAML
+# the cache only holds wheels, so a pure Python dulwich wheel is built from source and refreshed weekly
+if [ -z "$(find "$wheel_cache" -name 'dulwich-*-py3-none-any.whl' -mtime -7)" ]; then
+  echo "building pure Python dulwich wheel..."
+  PURE=1 pip --no-cache-dir wheel --no-deps --no-binary dulwich --wheel-dir "$wheel_cache" dulwich
+fi
+# installed by file name, since a compiled dulwich wheel that a project depends on may share the cache
+pure_wheel="$(ls -v "$wheel_cache"/dulwich-*-py3-none-any.whl 2> /dev/null | tail -n 1)"
+if [ -z "$pure_wheel" ]; then
+  echo "could not build dulwich"
+  exit 1
+fi
+cached_install "$pure_wheel"
 deactivate
 echo "copying modules from virtualenv to build directory"
 shopt -s dotglob
@@ -25,7 +37,4 @@ for file in $base_virtualenv_files; do
   rm -rf /tmp/build/python/${file}
 done
 cp -a /opt/python/boto* /tmp/build/python/
-# delete documentation and tests since they won't be used in Lambda environment
-rm -rf /tmp/build/python/docs
-rm -rf /tmp/build/python/dulwich/tests
 # cp /var/task/*.py /var/task/*.sh /tmp/build/
@@ -0,0 +1,22 @@
+#!/bin/bash
+# sourced by install_requirements.sh and setup_git.sh, once $runtime is set
+
+wheel_cache="${WHEEL_CACHE:-/tmp/wheels/${runtime}}"
+mkdir -p "$wheel_cache"
+
+# install from the wheel cache, only going to the package index for wheels that are missing from it
+cached_install() {
+  pip --no-cache-dir install --no-index --find-links "$wheel_cache" "$@" 2> /dev/null && return
+  echo "$(date) downloading wheels missing from cache..."
+  pip --no-cache-dir wheel --find-links "$wheel_cache" --wheel-dir "$wheel_cache" "$@" || return
+  pip --no-cache-dir install --no-index --find-links "$wheel_cache" "$@"
+}
+
+# pip wheel cannot --upgrade, so keep a pip wheel in the cache and upgrade from it, checking for a newer one weekly
+upgrade_pip() {
+  if [ -z "$(find "$wheel_cache" -name 'pip-*.whl' -mtime -7)" ]; then
+    pip --no-cache-dir download --only-binary :all: --dest "$wheel_cache" pip > /dev/null \
+      && touch "$(ls -v "$wheel_cache"/pip-*.whl | tail -n 1)"
+  fi
+  pip --no-cache-dir install --no-index --find-links "$wheel_cache" --upgrade pip
+}